@@ -1,94 +1,372 @@
 import streamlit as st
-from litellm import completion
-from typing import List, Tuple
-import json
+import httpx
+import litellm
+import tiktoken
+from aiolimiter import AsyncLimiter
+from litellm import acompletion
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from typing import Any, AsyncIterator, Coroutine, Dict, Iterator, List, Optional, Tuple, TypeVar
+import asyncio
+import hashlib
+import os
+import orjson
+import queue
 import re
+import textwrap
+import threading
+import time
+
+# Chat history limits: messages kept in the session, and messages shown outside the expander
+MAX_HISTORY_MESSAGES = 200
+VISIBLE_HISTORY_MESSAGES = 50
+
+# Precompiled patterns used when rendering messages
+_INLINE_MATH_RE = re.compile(r'(?<!\$)\$([^$]+)\$(?!\$)')
 
 # Initialize session state variables
 if 'messages' not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
+if 'message_count' not in st.session_state:
+    st.session_state.message_count = 0
+if 'rendered_message_count' not in st.session_state:
+    st.session_state.rendered_message_count = 0
 if 'enable_prompt_splitting' not in st.session_state:
     st.session_state.enable_prompt_splitting = False
 if 'model' not in st.session_state:
     st.session_state.model = "gpt-4o-mini"
+if 'independent_sub_queries' not in st.session_state:
+    st.session_state.independent_sub_queries = False
+if 'concurrency_limit' not in st.session_state:
+    st.session_state.concurrency_limit = 4
+if 'stop_event' not in st.session_state:
+    st.session_state.stop_event = threading.Event()
+
+# Connection pool settings for the shared HTTP clients
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+HTTP_TIMEOUT = 60.0
+
+# How long the script thread waits for new tokens before handing control back, so Stop can interrupt it
+STREAM_POLL_INTERVAL = 0.2
+
+T = TypeVar("T")
+
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Run a single event loop in a background thread so async clients outlive reruns."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """Worker threads for blocking calls that should not tie up the script thread."""
+    return ThreadPoolExecutor(max_workers=4)
+
+def run_async(coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine on the shared event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+@st.cache_resource
+def configure_http_clients() -> None:
+    """Route all liteLLM calls through a keep-alive HTTP/2 connection pool."""
+    litellm.aclient_session = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+configure_http_clients()
+
+# System message to enforce standard LaTeX delimiters
+LATEX_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "When including LaTeX equations, use `$$...$$` for display-style equations (on their own line) and `$...$` for inline equations (within text). Do not use square brackets `[...]` for equations unless they are part of regular text."
+}
+
+# Upper bound on the number of sub-queries a prompt is split into
+MAX_SUB_QUERIES = 5
+
+# Prompt templates, built once instead of on every call
+DECOMPOSITION_PROMPT_TEMPLATE = """
+Break down this complex query into smaller, logically connected sub-queries. Consider:
+1. Dependencies between questions
+2. Context needed for each sub-query
+3. Logical flow of information
+
+Complex query: "{query}"
+
+Use at most {max_sub_queries} sub-queries. Return a JSON object whose "sub_queries" array holds one string per sub-query. Format:
+{{"sub_queries": ["sub-query 1", "sub-query 2", ...]}}
+
+The sub-queries should build upon each other naturally and maintain context.
+"""
+
+# Structured output schema so the decomposition is always parseable JSON
+DECOMPOSITION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "subqueries",
+        "schema": {
+            "type": "object",
+            "properties": {
+                "sub_queries": {
+                    "type": "array",
+                    "items": {"type": "string"},
+                    "maxItems": MAX_SUB_QUERIES
+                }
+            },
+            "required": ["sub_queries"]
+        }
+    }
+}
+
+CONTEXT_PROMPT_TEMPLATE = """
+Given this context from previous responses:
+{context}
+
+Please address this follow-up question while considering the above context:
+{prompt}
+"""
+
+# Client-side rate limits per model, shared by all sessions since they share the API account
+REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = int(os.environ.get("LLM_TOKENS_PER_MINUTE", "200000"))
+
+# Response cache settings
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+
+class ResponseCache:
+    """Thread-safe LRU cache of model responses keyed by a hash of (model, prompt)."""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        return hashlib.blake2b(f"{model}\0{prompt}".encode()).hexdigest()
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        key = self.key(model, prompt)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, response = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def put(self, model: str, prompt: str, response: str) -> None:
+        key = self.key(model, prompt)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """Share one response cache across all sessions and reruns."""
+    return ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+
+@st.cache_resource
+def get_rate_limiters(model: str) -> Tuple[AsyncLimiter, AsyncLimiter]:
+    """Token buckets pacing requests and input tokens per minute for one model."""
+    return AsyncLimiter(REQUESTS_PER_MINUTE, 60), AsyncLimiter(TOKENS_PER_MINUTE, 60)
+
+@st.cache_resource
+def get_encoding(model: str) -> Optional[tiktoken.Encoding]:
+    """Load the tokenizer for a model once, falling back to o200k_base for unknown models.
+
+    Returns None if the encoding cannot be loaded, e.g. when its BPE file cannot be downloaded.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
+
+def count_tokens(text: str, model: str) -> int:
+    """Count the tokens in a piece of text for the given model, estimating if no tokenizer is available."""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+async def rate_limited_acompletion(model: str, messages: List[Dict[str, str]], **kwargs: Any) -> Any:
+    """Call litellm.acompletion once the request and token budgets allow it."""
+    request_limiter, token_limiter = get_rate_limiters(model)
+    # A single request may never ask for more than the whole bucket
+    tokens = min(sum(count_tokens(m["content"], model) for m in messages), TOKENS_PER_MINUTE)
+    async with request_limiter:
+        await token_limiter.acquire(tokens)
+        return await acompletion(model=model, messages=messages, **kwargs)
+
+@st.cache_resource
+def get_inflight_requests() -> Dict[str, "asyncio.Future[str]"]:
+    """Futures for requests currently in flight, keyed like the response cache.
+
+    Only touched from the shared event loop, so it needs no lock.
+    """
+    return {}
 
 def get_ai_response(prompt: str, model: str = "gpt-4o-mini") -> str:
     """Get response from AI model using liteLLM."""
+    return "".join(get_ai_response_stream(prompt, model))
+
+def get_ai_response_stream(prompt: str, model: str = "gpt-4o-mini") -> Iterator[str]:
+    """Stream response tokens from AI model using liteLLM as they arrive."""
+    updates: "queue.Queue[Optional[Tuple[int, str]]]" = queue.Queue()
+    asyncio.run_coroutine_threadsafe(stream_ai_responses([prompt], updates, model=model), get_event_loop())
+    while (update := updates.get()) is not None:
+        yield update[1]
+
+class StreamError(str):
+    """The error message a response stream yields in place of further tokens when the request fails."""
+
+async def astream_ai_response(prompt: str, model: str = "gpt-4o-mini") -> AsyncIterator[str]:
+    """Stream response tokens from AI model asynchronously using liteLLM.
+
+    If an identical request is already streaming, its full text is yielded once it completes.
+    A failure is yielded as a StreamError, possibly after some tokens have already been streamed.
+    """
+    cache = get_response_cache()
+    cached = cache.get(model, prompt)
+    if cached is not None:
+        yield cached
+        return
+    inflight = get_inflight_requests()
+    key = ResponseCache.key(model, prompt)
+    while (leader := inflight.get(key)) is not None:
+        # asyncio.wait neither cancels the leader nor raises when the leader was cancelled
+        await asyncio.wait({leader})
+        if not leader.cancelled():
+            yield leader.result()
+            return
+        # The leader's stream was abandoned (e.g. Stop in its session), so request it ourselves
+    future = asyncio.get_running_loop().create_future()
+    inflight[key] = future
+    parts = []
     try:
-        # System message to enforce standard LaTeX delimiters
-        system_message = {
-            "role": "system",
-            "content": "When including LaTeX equations, use `$$...$$` for display-style equations (on their own line) and `$...$` for inline equations (within text). Do not use square brackets `[...]` for equations unless they are part of regular text."
-        }
-        response = completion(
+        response = await rate_limited_acompletion(
             model=model,
-            messages=[system_message, {"role": "user", "content": prompt}],
-            max_tokens=2000
+            messages=[LATEX_SYSTEM_MESSAGE, {"role": "user", "content": prompt}],
+            max_tokens=2000,
+            stream=True
         )
-        return response.choices[0].message.content
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            parts.append(delta)
+            yield delta
+        content = "".join(parts)
+        if content:
+            cache.put(model, prompt, content)
+        future.set_result(content)
     except Exception as e:
-        return f"Error: {str(e)}"
+        error = StreamError(f"Error: {str(e)}")
+        future.set_result(error)
+        yield error
+    finally:
+        inflight.pop(key, None)
+        if not future.done():
+            # The stream was abandoned part-way; waiting duplicates will issue their own request
+            future.cancel()
+
+async def stream_ai_responses(prompts: List[str], updates: "queue.Queue[Optional[Tuple[int, str]]]", model: str = "gpt-4o-mini", concurrency_limit: int = 4, stop_event: Optional[threading.Event] = None) -> None:
+    """Stream responses for independent prompts concurrently, pushing (index, delta) pairs onto `updates`.
+
+    Streams stop early once `stop_event` is set. A final None is pushed once every stream has finished.
+    """
+    semaphore = asyncio.Semaphore(concurrency_limit)
+
+    async def run(index: int, prompt: str) -> None:
+        async with semaphore:
+            stream = astream_ai_response(prompt, model)
+            try:
+                async for delta in stream:
+                    if stop_event is not None and stop_event.is_set():
+                        break
+                    updates.put((index, delta))
+            finally:
+                await stream.aclose()
+
+    try:
+        await asyncio.gather(*[run(i, p) for i, p in enumerate(prompts)])
+    finally:
+        updates.put(None)
+
+# Connectives that suggest a prompt asks for several steps
+_MULTI_STEP_RE = re.compile(r'\b(and then|also|after that|finally)\b', re.IGNORECASE)
+
+def needs_decomposition(prompt: str) -> bool:
+    """Cheaply guess whether a prompt is complex enough to be worth splitting."""
+    return len(prompt) > 200 or prompt.count("?") > 1 or bool(_MULTI_STEP_RE.search(prompt))
 
 def ai_prompt_decomposition(complex_prompt: str) -> List[str]:
     """Use AI to break down a complex prompt into smaller, logically connected prompts."""
-    decomposition_prompt = f"""
-    Break down this complex query into smaller, logically connected sub-queries. Consider:
-    1. Dependencies between questions
-    2. Context needed for each sub-query
-    3. Logical flow of information
-    
-    Complex query: "{complex_prompt}"
-    
-    Return ONLY a JSON array of strings, where each string is a sub-query. Format:
-    ["sub-query 1", "sub-query 2", ...]
-    
-    The sub-queries should build upon each other naturally and maintain context.
-    """
-    
+    # Skip the decomposition round-trip for prompts that would come back unsplit
+    if not needs_decomposition(complex_prompt):
+        return [complex_prompt]
+
+    decomposition_prompt = DECOMPOSITION_PROMPT_TEMPLATE.format(
+        query=complex_prompt, max_sub_queries=MAX_SUB_QUERIES
+    )
+
     try:
-        response = completion(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": decomposition_prompt}],
-            max_tokens=2000
-        )
+        # The same complex prompt should always produce the same split
+        cache = get_response_cache()
+        response_text = cache.get("gpt-4o-mini", decomposition_prompt)
+        is_cached = response_text is not None
+        if not is_cached:
+            response = run_async(rate_limited_acompletion(
+                model="gpt-4o-mini",
+                messages=[{"role": "user", "content": decomposition_prompt}],
+                max_tokens=200,
+                response_format=DECOMPOSITION_RESPONSE_FORMAT
+            ))
+            choice = response.choices[0]
+            if choice.finish_reason == "length":
+                raise ValueError("the sub-query list was cut off at the token limit")
+            response_text = choice.message.content
         
-        # Extract JSON array from response
-        response_text = response.choices[0].message.content
-        # Find the JSON array in the response (it might have additional text)
-        start_idx = response_text.find('[')
-        end_idx = response_text.rfind(']') + 1
-        if start_idx != -1 and end_idx != -1:
-            json_str = response_text[start_idx:end_idx]
-            sub_prompts = json.loads(json_str)
-            return sub_prompts if isinstance(sub_prompts, list) else []
-        return [complex_prompt]
+        sub_prompts = orjson.loads(response_text)["sub_queries"]
+        if not isinstance(sub_prompts, list) or not sub_prompts or not all(isinstance(p, str) for p in sub_prompts):
+            return [complex_prompt]
+        # Only cache replies that parsed, so a bad one is retried on the next submit
+        if not is_cached:
+            cache.put("gpt-4o-mini", decomposition_prompt, response_text)
+        return sub_prompts[:MAX_SUB_QUERIES]
     except Exception as e:
         st.error(f"Error in prompt decomposition: {str(e)}")
         return [complex_prompt]
 
+def build_context_prompt(context_parts: List[str], prompt: str) -> str:
+    """Wrap a follow-up prompt with the Q/A pairs answered so far, if any."""
+    if not context_parts:
+        return prompt
+    return CONTEXT_PROMPT_TEMPLATE.format(context="\n".join(context_parts), prompt=prompt)
+
 def process_prompt_chain(prompts: List[str]) -> List[Tuple[str, str]]:
     """Process a chain of prompts and get AI responses with context awareness."""
     responses = []
-    context = ""
+    context_parts: List[str] = []
     
-    for i, prompt in enumerate(prompts):
+    for prompt in prompts:
         # Create a context-aware prompt that includes previous interactions
-        if context:
-            context_prompt = f"""
-            Given this context from previous responses: 
-            {context}
-            
-            Please address this follow-up question while considering the above context:
-            {prompt}
-            """
-        else:
-            context_prompt = prompt
-            
+        context_prompt = build_context_prompt(context_parts, prompt)
         response = get_ai_response(context_prompt)
         responses.append((prompt, response))
         
         # Update context with the latest response
-        context += f"\nQ: {prompt}\nA: {response}\n"
+        context_parts.append(f"Q: {prompt}\nA: {response}")
     
     return responses
 
@@ -104,85 +382,320 @@ st.session_state.enable_prompt_splitting = enable_splitting
 selected_model = st.sidebar.text_input("AI Model", value=st.session_state.model)
 st.session_state.model = selected_model
 
+# Clicking Stop reruns the app, interrupting the current answer; the event also ends its streams
+if st.sidebar.button("Stop generating", help="Interrupt the response currently being generated."):
+    st.session_state.stop_event.set()
+
 if enable_splitting:
     st.sidebar.info("Smart prompt splitting is enabled. Complex questions will be broken down and answered step by step.")
+    independent = st.sidebar.toggle(
+        "Independent sub-queries",
+        value=st.session_state.independent_sub_queries,
+        help="Answer all sub-queries in parallel without chaining context between them."
+    )
+    st.session_state.independent_sub_queries = independent
+    if independent:
+        concurrency_limit = st.sidebar.number_input(
+            "Max concurrent requests", min_value=1, max_value=16,
+            value=st.session_state.concurrency_limit
+        )
+        st.session_state.concurrency_limit = concurrency_limit
 
-def format_message_content(content: str) -> None:
-    """Format and display message content with proper rendering of Markdown, LaTeX, and code blocks."""
-    # Split content only by code blocks
-    code_block_pattern = r'(```[\w]*\n[\s\S]*?```)'
-    parts = re.split(code_block_pattern, content)
-    
-    for part in parts:
+def _fence_line_start(text: str, index: int) -> int:
+    """Return where the line holding index starts, or -1 if anything but spaces or tabs precedes index on it."""
+    line_start = text.rfind('\n', 0, index) + 1
+    return line_start if not text[line_start:index].strip(' \t') else -1
+
+def _split_code_fences(text: str) -> List[Tuple[str, str]]:
+    """Split text into ("text", ...) and ("code", ...) pieces by pairing ``` fences in a single pass.
+
+    Fences only count at the start of a line, optionally indented (e.g. inside a list item), and an
+    opening fence must be followed by an optional language name and a newline, so ``` mentioned in
+    prose stays text.
+    """
+    pieces = []
+    pos = 0
+    search = 0
+    while (start := text.find('```', search)) != -1:
+        search = start + 3
+        line_start = _fence_line_start(text, start)
+        if line_start == -1:
+            continue
+        newline = text.find('\n', start + 3)
+        if newline == -1:
+            break  # No line can follow, so no block can open
+        if not all(c.isalnum() or c == '_' for c in text[start + 3:newline].rstrip()):
+            continue
+        end = text.find('```', newline)
+        while end != -1 and _fence_line_start(text, end) == -1:
+            end = text.find('```', end + 3)
+        if end == -1:
+            break  # Unmatched fence, leave the rest as text
+        pieces.append(("text", text[pos:line_start]))
+        pieces.append(("code", text[line_start:end + 3]))
+        pos = search = end + 3
+    pieces.append(("text", text[pos:]))
+    return pieces
+
+def _convert_display_latex(text: str) -> str:
+    """Rewrite \\[ ... \\] display equations as $$ ... $$ in a single pass, leaving `code` spans alone."""
+    out = []
+    pos = 0
+    search = 0
+    while (start := text.find('\\[', search)) != -1:
+        tick = text.find('`', search)
+        if tick != -1 and tick < start:
+            # Skip an inline code span, closed by a backtick run of the same length
+            run_end = tick
+            while run_end < len(text) and text[run_end] == '`':
+                run_end += 1
+            close = text.find(text[tick:run_end], run_end)
+            search = close + (run_end - tick) if close != -1 else run_end
+            continue
+        end = text.find('\\]', start + 2)
+        if end == -1:
+            break  # Unterminated equation, leave the rest untouched
+        out.append(text[pos:start])
+        out.append('\n$$\n' + text[start + 2:end].strip() + '\n$$\n')
+        pos = search = end + 2
+    out.append(text[pos:])
+    return ''.join(out)
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def tokenize_message_content(content: str) -> List[Tuple[str, str, str]]:
+    """Split message content into ("code", code, language) and ("markdown", text, "") pieces."""
+    # Messages never change after being appended, so this runs once per message
+    pieces = []
+    for kind, part in _split_code_fences(content):
         if not part.strip():
             continue
-        if re.match(code_block_pattern, part):
+        if kind == "code":
             # Handle code block
             lines = part.split('\n')
-            lang = lines[0][3:].strip()  # Get language if specified
-            code = '\n'.join(lines[1:-1]).strip()  # Extract code content
-            st.code(code, language=lang if lang else "python", line_numbers=True, wrap_lines=True)
+            lang = lines[0].strip()[3:].strip()  # Get language if specified
+            code = textwrap.dedent('\n'.join(lines[1:-1])).strip()  # Extract code content, minus any list indent
+            pieces.append(("code", code, lang if lang else "python"))
         else:
-            # Replace $...$ with \(...\) for inline math to ensure rendering
-            part = re.sub(r'(?<!\$)\$([^$]+)\$(?!\$)', r'\\(\1\\)', part)
-            st.markdown(part, unsafe_allow_html=True)
+            # Convert \[...\] display equations; markdown renders $$...$$ itself.
+            # Then replace $...$ with \(...\) for inline math to ensure rendering
+            part = _convert_display_latex(part)
+            pieces.append(("markdown", _INLINE_MATH_RE.sub(r'\\(\1\\)', part), ""))
+    return pieces
 
-# Display chat history
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        format_message_content(message["content"])
+def format_message_content(content: str) -> None:
+    """Format and display message content with proper rendering of Markdown, LaTeX, and code blocks."""
+    for kind, text, lang in tokenize_message_content(content):
+        if kind == "code":
+            st.code(text, language=lang, line_numbers=True, wrap_lines=True)
+        else:
+            st.markdown(text, unsafe_allow_html=True)
+
+def display_streamed_responses(prompts: List[str], headers: List[str], model: str, concurrency_limit: int = 4, stop_event: Optional[threading.Event] = None) -> Tuple[List[str], bool]:
+    """Stream responses for all prompts at once, each into its own chat message below its header.
+
+    Returns the responses and whether any of them failed.
+    """
+    containers = [st.chat_message("assistant").empty() for _ in prompts]
+    buffers = [""] * len(prompts)
+    failed = False
+    updates: "queue.Queue[Optional[Tuple[int, str]]]" = queue.Queue()
+    asyncio.run_coroutine_threadsafe(
+        stream_ai_responses(prompts, updates, model=model, concurrency_limit=concurrency_limit, stop_event=stop_event),
+        get_event_loop()
+    )
+
+    def render(index: int) -> None:
+        header = headers[index]
+        containers[index].markdown(f"{header}\n\n{buffers[index]}" if header else buffers[index])
+
+    while True:
+        try:
+            update = updates.get(timeout=STREAM_POLL_INTERVAL)
+        except queue.Empty:
+            # Redraw while waiting; every Streamlit call is a point where Stop can interrupt the run
+            for index in range(len(prompts)):
+                render(index)
+            continue
+        # Apply every delta that has arrived before redrawing the affected parts
+        changed = set()
+        while update is not None:
+            index, delta = update
+            buffers[index] += delta
+            failed = failed or isinstance(delta, StreamError)
+            changed.add(index)
+            try:
+                update = updates.get_nowait()
+            except queue.Empty:
+                break
+        for index in changed:
+            render(index)
+        if update is None:
+            return buffers, failed
+
+def append_message(role: str, content: str) -> None:
+    """Append a message to the chat history, tagging it with a sequential id and token count."""
+    st.session_state.messages.append({
+        "id": st.session_state.message_count,
+        "role": role,
+        "content": content,
+        # Counted once here so reruns never re-encode the history
+        "tokens": count_tokens(content, st.session_state.model)
+    })
+    st.session_state.message_count += 1
+
+def decompose_in_background(prompt: str) -> List[str]:
+    """Run prompt decomposition on a worker thread, keeping the script responsive while it waits."""
+    ctx = get_script_run_ctx()
+
+    def decompose() -> List[str]:
+        # Let the worker report errors into this session
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return ai_prompt_decomposition(prompt)
+
+    future = get_executor().submit(decompose)
+    status = st.empty()
+    started = time.monotonic()
+    # Each status update is a point where Streamlit can interrupt the run, e.g. for Stop
+    while not future.done():
+        status.caption(f"Analyzing your question... {time.monotonic() - started:.1f}s")
+        time.sleep(0.1)
+    status.empty()
+    return future.result()
+
+def last_user_prompt() -> Optional[str]:
+    """Return the most recent user message in the history, if any."""
+    for message in reversed(st.session_state.messages):
+        if message["role"] == "user":
+            return message["content"]
+    return None
+
+def handle_prompt(prompt: str) -> None:
+    """Answer a user prompt, displaying and recording the responses."""
+    # Replies depend on the model and splitting modes as well as the prompt itself
+    response_key = ResponseCache.key(
+        f"{st.session_state.model}:{st.session_state.enable_prompt_splitting}:{st.session_state.independent_sub_queries}",
+        prompt
+    )
+    is_resubmit = last_user_prompt() == prompt
 
-# Chat input
-if prompt := st.chat_input("What would you like to know?"):
     # Display user message
     with st.chat_message("user"):
         st.markdown(prompt)
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    append_message("user", prompt)
+
+    # Replay the previous answer when the same prompt is submitted again
+    last_response = st.session_state.get("last_response")
+    if is_resubmit and last_response is not None and last_response[0] == response_key:
+        for content in last_response[1]:
+            with st.chat_message("assistant"):
+                format_message_content(content)
+            append_message("assistant", content)
+        return
+
+    first_response_id = st.session_state.message_count
+    replies: List[str] = []
+    failed = False
+    # A fresh event per prompt, so a stale Stop never cancels the next answer
+    stop_event = st.session_state.stop_event = threading.Event()
 
     # Process the prompt based on splitting setting
     if st.session_state.enable_prompt_splitting:
-        with st.spinner("Analyzing your question..."):
-            sub_prompts = ai_prompt_decomposition(prompt)
+        sub_prompts = decompose_in_background(prompt)
         
         if len(sub_prompts) > 1:
             st.info(f"I'll break this down into {len(sub_prompts)} parts to provide a more thorough response.")
             
-            # Process and display each sub-prompt immediately
-            context = ""
-            for i, sub_prompt in enumerate(sub_prompts, 1):
-                # Create a context-aware prompt
-                if context:
-                    context_prompt = f"""
-                    Given this context from previous responses: 
-                    {context}
-                    
-                    Please address this follow-up question while considering the above context:
-                    {sub_prompt}
-                    """
-                else:
-                    context_prompt = sub_prompt
+            if st.session_state.independent_sub_queries:
+                # Stream all sub-prompts concurrently, without chaining context
+                responses, failed = display_streamed_responses(
+                    sub_prompts,
+                    [f"**Part {i}**: *{sub_prompt}*" for i, sub_prompt in enumerate(sub_prompts, 1)],
+                    model=st.session_state.model,
+                    concurrency_limit=st.session_state.concurrency_limit,
+                    stop_event=stop_event
+                )
+                for i, (sub_prompt, response) in enumerate(zip(sub_prompts, responses), 1):
+                    append_message("assistant", f"**Part {i}**: {sub_prompt}\n\n{response}")
+                replies.extend(responses)
+            else:
+                # Process and display each sub-prompt immediately
+                context_parts: List[str] = []
+                for i, sub_prompt in enumerate(sub_prompts, 1):
+                    # Create a context-aware prompt
+                    context_prompt = build_context_prompt(context_parts, sub_prompt)
                 
-                # Get and display the response immediately
-                response = get_ai_response(context_prompt)
-                with st.chat_message("assistant"):
-                    st.markdown(f"**Part {i}**: *{sub_prompt}*\n\n{response}")
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": f"**Part {i}**: {sub_prompt}\n\n{response}"
-                })
+                    # Stream the response as it is generated
+                    responses, part_failed = display_streamed_responses(
+                        [context_prompt], [f"**Part {i}**: *{sub_prompt}*"],
+                        model=st.session_state.model, stop_event=stop_event
+                    )
+                    response = responses[0]
+                    failed = failed or part_failed
+                    append_message("assistant", f"**Part {i}**: {sub_prompt}\n\n{response}")
+                    replies.append(response)
                 
-                # Update context for the next sub-prompt
-                context += f"\nQ: {sub_prompt}\nA: {response}\n"
+                    # Update context for the next sub-prompt
+                    context_parts.append(f"Q: {sub_prompt}\nA: {response}")
         else:
             # Handle single prompt case
-            response = get_ai_response(prompt, model=st.session_state.model)
-            with st.chat_message("assistant"):
-                st.markdown(response)
-            st.session_state.messages.append({"role": "assistant", "content": response})
+            responses, failed = display_streamed_responses(
+                [prompt], [""], model=st.session_state.model, stop_event=stop_event
+            )
+            response = responses[0]
+            append_message("assistant", response)
+            replies.append(response)
     else:
         # Normal chat mode
-        response = get_ai_response(prompt, model=st.session_state.model)
-        with st.chat_message("assistant"):
-            st.markdown(response)
-        st.session_state.messages.append({"role": "assistant", "content": response})
+        responses, failed = display_streamed_responses(
+            [prompt], [""], model=st.session_state.model, stop_event=stop_event
+        )
+        response = responses[0]
+        append_message("assistant", response)
+        replies.append(response)
+
+    # Never keep failed, stopped or empty replies, so resubmitting retries them
+    if not failed and not stop_event.is_set() and all(replies):
+        st.session_state.last_response = (response_key, [
+            message["content"] for message in st.session_state.messages
+            if message["id"] >= first_response_id and message["role"] == "assistant"
+        ])
+
+@st.fragment
+def render_history() -> None:
+    """Display the chat history as of the last full script run."""
+    messages = list(st.session_state.messages)
+    older, recent = messages[:-VISIBLE_HISTORY_MESSAGES], messages[-VISIBLE_HISTORY_MESSAGES:]
+    if older:
+        with st.expander(f"Show full history ({len(older)} earlier messages)"):
+            for message in older:
+                with st.chat_message(message["role"]):
+                    format_message_content(message["content"])
+    for message in recent:
+        with st.chat_message(message["role"]):
+            format_message_content(message["content"])
+    st.session_state.rendered_message_count = st.session_state.message_count
+
+@st.fragment
+def chat_panel() -> None:
+    """Display messages added since the last full run and handle chat input.
+
+    Submitting a prompt only reruns this fragment, so earlier history is not re-rendered.
+    """
+    for message in st.session_state.messages:
+        if message["id"] >= st.session_state.rendered_message_count:
+            with st.chat_message(message["role"]):
+                format_message_content(message["content"])
+    # New turns are drawn here, above the input, which sits inline inside the fragment
+    turn_area = st.container()
+
+    total_tokens = sum(message.get("tokens", 0) for message in st.session_state.messages)
+    if total_tokens:
+        st.caption(f"Conversation size: {total_tokens:,} tokens")
+
+    if prompt := st.chat_input("What would you like to know?"):
+        with turn_area:
+            handle_prompt(prompt)
+        st.rerun(scope="fragment")
 
+render_history()
+chat_panel()